@@ -1,19 +1,63 @@
+import csv
+import io
 import os
 import json
 import re
 import secrets
-import string
+import sys
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env
 load_dotenv()
 
+# Снимок окружения: os.getenv каждый раз линейно сканирует environ,
+# поэтому читаем его один раз в обычный словарь
+_ENV = dict(os.environ)
+
+# Переводим stdout в блочную буферизацию: при 1-2 print на пользователя
+# построчный сброс в терминал/пайп превращается в поток syscall'ов.
+# Прогресс сбрасывается вручную каждые 1000 пользователей.
+if hasattr(sys.stdout, 'reconfigure'):
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
+
+# orjson парсит и сериализует JSON в разы быстрее stdlib;
+# если он не установлен, прозрачно откатываемся на стандартный json
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj):
+        return json.dumps(obj)
+
 # ============================================
 # УНИВЕРСАЛЬНЫЙ КЛАСС ДЛЯ РАБОТЫ С БД
 # ============================================
 
+# Заменяем %s на ? для SQLite (только если это не часть строки)
+# Компилируем один раз, чтобы не гонять движок regex на каждом запросе
+_PLACEHOLDER_RE = re.compile(r'(?<!["\'])%s(?!["\'])')
+
+@lru_cache(maxsize=None)
+def _adapt_query(query, db_type):
+    """Адаптирует плейсхолдеры под тип БД; каждый уникальный запрос
+    переписывается ровно один раз"""
+    if db_type == 'sqlite':
+        # Безопасная замена: только если %s не внутри кавычек
+        return _PLACEHOLDER_RE.sub('?', query)
+    return query
+
 class DatabaseConnection:
     """Универсальный класс для работы с разными типами БД"""
     
@@ -21,6 +65,7 @@ class DatabaseConnection:
         self.db_type = db_type.lower()
         self.connection = None
         self.cursor = None
+        self.pool = None
         self._connect(**kwargs)
     
     def _connect(self, **kwargs):
@@ -30,20 +75,44 @@ class DatabaseConnection:
             db_path = kwargs.get('db_path', 'database.db')
             self.connection = sqlite3.connect(db_path)
             self.cursor = self.connection.cursor()
+            # Большой кэш страниц и mmap-чтение безопасны для любой БД
+            pragmas = [
+                "PRAGMA cache_size=-262144",
+                "PRAGMA mmap_size=1073741824",
+            ]
+            if kwargs.get('tune_for_writes'):
+                # Только для целевой БД: journal_mode=WAL записывается
+                # в сам файл и требует блокировки на запись — исходную
+                # базу 3X-UI трогать нельзя
+                pragmas += [
+                    "PRAGMA journal_mode=WAL",
+                    "PRAGMA synchronous=NORMAL",
+                    "PRAGMA temp_store=MEMORY",
+                ]
+            for pragma in pragmas:
+                self.cursor.execute(pragma)
             
         elif self.db_type in ['postgresql', 'postgres']:
             try:
-                import psycopg2
+                from psycopg2.pool import ThreadedConnectionPool
             except ImportError:
                 raise ImportError("psycopg2-binary не установлен. Установите: pip install psycopg2-binary")
-            
-            self.connection = psycopg2.connect(
+
+            # Пул соединений: основное соединение используется для
+            # последовательных запросов, остальные раздаются параллельным
+            # воркерам через getconn()/putconn() (одно соединение нельзя
+            # делить между потоками). Основное соединение занято всегда,
+            # поэтому размер пула — pool_size воркеров плюс один: getconn()
+            # не ждет свободного соединения, а сразу бросает PoolError
+            self.pool = ThreadedConnectionPool(
+                1, kwargs.get('pool_size', 8) + 1,
                 host=kwargs.get('host', 'localhost'),
                 port=kwargs.get('port', 5432),
                 database=kwargs.get('database', 'postgres'),
                 user=kwargs.get('user', 'postgres'),
                 password=kwargs.get('password', '')
             )
+            self.connection = self.pool.getconn()
             self.cursor = self.connection.cursor()
             
         elif self.db_type in ['mysql', 'mariadb']:
@@ -66,19 +135,19 @@ class DatabaseConnection:
     
     def execute(self, query, params=None):
         """Выполняет SQL запрос с параметрами"""
-        # Адаптируем плейсхолдеры для разных БД
+        # Адаптируем плейсхолдеры для разных БД:
+        # PostgreSQL и MySQL используют %s, SQLite использует ?
         if params:
-            # PostgreSQL и MySQL используют %s
-            # SQLite использует ?
-            if self.db_type == 'sqlite':
-                # Заменяем %s на ? для SQLite (только если это не часть строки)
-                # Безопасная замена: только если %s не внутри кавычек
-                query = re.sub(r'(?<!["\'])%s(?!["\'])', '?', query)
-            # Для PostgreSQL и MySQL/MariaDB используем %s как есть
-            
+            query = _adapt_query(query, self.db_type)
         self.cursor.execute(query, params or ())
         return self.cursor
-    
+
+    def executemany(self, query, seq_of_params):
+        """Выполняет SQL запрос для каждого набора параметров одной пачкой"""
+        query = _adapt_query(query, self.db_type)
+        self.cursor.executemany(query, seq_of_params)
+        return self.cursor
+
     def fetchone(self):
         """Получает одну строку результата"""
         return self.cursor.fetchone()
@@ -87,15 +156,34 @@ class DatabaseConnection:
         """Получает все строки результата"""
         return self.cursor.fetchall()
     
+    def begin(self):
+        """Явно открывает транзакцию"""
+        if self.db_type == 'sqlite':
+            if not self.connection.in_transaction:
+                self.cursor.execute("BEGIN")
+        # psycopg2 и pymysql работают с autocommit=False
+        # и открывают транзакцию неявно при первом запросе
+
     def commit(self):
         """Сохраняет изменения"""
         self.connection.commit()
     
+    def getconn(self):
+        """Выдает отдельное соединение из пула (только PostgreSQL)"""
+        return self.pool.getconn()
+
+    def putconn(self, conn):
+        """Возвращает соединение в пул (только PostgreSQL)"""
+        self.pool.putconn(conn)
+
     def close(self):
         """Закрывает соединение"""
         if self.cursor:
             self.cursor.close()
-        if self.connection:
+        if self.pool:
+            self.pool.putconn(self.connection)
+            self.pool.closeall()
+        elif self.connection:
             self.connection.close()
     
     @property
@@ -115,19 +203,86 @@ class DatabaseConnection:
 
 def generate_password(min_length=22):
     """Генерирует случайный пароль минимум 22 символа"""
-    alphabet = string.ascii_letters + string.digits
-    password = ''.join(secrets.choice(alphabet) for _ in range(min_length))
-    return password
+    # Одно чтение urandom вместо min_length вызовов secrets.choice
+    return secrets.token_urlsafe(min_length)[:min_length]
+
+# SQL для массовой вставки пользователей (обычная и execute_values-форма)
+USERS_INSERT_QUERY = """
+    INSERT INTO users (
+        username, status, used_traffic, data_limit, created_at,
+        admin_id, data_limit_reset_strategy, expire, proxy_settings
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+# COPY на порядок быстрее даже multi-VALUES INSERT: PostgreSQL не парсит
+# и не планирует каждую строку отдельно
+USERS_COPY_QUERY = r"""
+    COPY users (
+        username, status, used_traffic, data_limit, created_at,
+        admin_id, data_limit_reset_strategy, expire, proxy_settings
+    ) FROM STDIN WITH (FORMAT csv, NULL '\N')
+"""
+
+def _rows_to_csv(rows):
+    """Собирает строки в CSV-буфер для COPY FROM STDIN"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(['\\N' if value is None else value for value in row])
+    buf.seek(0)
+    return buf
+
+USERS_UPDATE_QUERY = """
+    UPDATE users SET
+        status = %s,
+        used_traffic = %s,
+        data_limit = %s,
+        expire = %s,
+        proxy_settings = %s,
+        created_at = %s,
+        edit_at = %s
+    WHERE id = %s
+"""
+
+def bulk_update_users(pasar_cur, rows, db_type):
+    """Массово обновляет существующих пользователей одной пачкой"""
+    if not rows:
+        return
+    if db_type in ['postgresql', 'postgres']:
+        from psycopg2.extras import execute_batch
+        execute_batch(pasar_cur.cursor, USERS_UPDATE_QUERY, rows, page_size=1000)
+    else:
+        pasar_cur.executemany(USERS_UPDATE_QUERY, rows)
+
+def bulk_insert_users(pasar_cur, rows, db_type):
+    """Массово вставляет пользователей одной пачкой вместо построчных INSERT"""
+    if not rows:
+        return
+    if db_type in ['postgresql', 'postgres']:
+        pasar_cur.cursor.copy_expert(USERS_COPY_QUERY, _rows_to_csv(rows))
+    else:
+        # MySQL/SQLite: executemany сам адаптирует плейсхолдеры
+        pasar_cur.executemany(USERS_INSERT_QUERY, rows)
+
+def insert_users_shard_pg(pasar, rows):
+    """Вставляет шард пользователей через отдельное соединение из пула (PostgreSQL)"""
+    conn = pasar.getconn()
+    try:
+        cur = conn.cursor()
+        cur.copy_expert(USERS_COPY_QUERY, _rows_to_csv(rows))
+        conn.commit()
+        cur.close()
+    finally:
+        pasar.putconn(conn)
+
+# Формат UUID с дефисами: проверка по regex не создает объект uuid.UUID
+# и не бросает исключения на каждом невалидном значении
+_UUID_RE = re.compile(r'\A[0-9a-fA-F]{8}(-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}\Z')
 
 def is_valid_uuid(value):
     """Проверяет, является ли строка валидным UUID"""
     if not value:
         return False
-    try:
-        uuid.UUID(value)
-        return True
-    except (ValueError, AttributeError):
-        return False
+    return bool(_UUID_RE.match(value))
 
 # ============================================
 # ЗАГРУЗКА КОНФИГУРАЦИИ ИЗ .ENV
@@ -135,60 +290,62 @@ def is_valid_uuid(value):
 
 def get_xui_db_config():
     """Получает конфигурацию БД для 3X-UI"""
-    db_type = os.getenv('XUI_DB_TYPE', 'sqlite').lower()
+    db_type = _ENV.get('XUI_DB_TYPE', 'sqlite').lower()
     
     if db_type == 'sqlite':
         return {
             'db_type': 'sqlite',
-            'db_path': os.getenv('XUI_DB_PATH', 'x-ui.db')
+            'db_path': _ENV.get('XUI_DB_PATH', 'x-ui.db')
         }
     elif db_type in ['postgresql', 'postgres']:
         return {
             'db_type': 'postgresql',
-            'host': os.getenv('XUI_DB_HOST', 'localhost'),
-            'port': int(os.getenv('XUI_DB_PORT', 5432)),
-            'database': os.getenv('XUI_DB_NAME', 'xui'),
-            'user': os.getenv('XUI_DB_USER', 'postgres'),
-            'password': os.getenv('XUI_DB_PASSWORD', '')
+            'host': _ENV.get('XUI_DB_HOST', 'localhost'),
+            'port': int(_ENV.get('XUI_DB_PORT', 5432)),
+            'database': _ENV.get('XUI_DB_NAME', 'xui'),
+            'user': _ENV.get('XUI_DB_USER', 'postgres'),
+            'password': _ENV.get('XUI_DB_PASSWORD', '')
         }
     elif db_type in ['mysql', 'mariadb']:
         return {
             'db_type': db_type,
-            'host': os.getenv('XUI_DB_HOST', 'localhost'),
-            'port': int(os.getenv('XUI_DB_PORT', 3306)),
-            'database': os.getenv('XUI_DB_NAME', 'xui'),
-            'user': os.getenv('XUI_DB_USER', 'root'),
-            'password': os.getenv('XUI_DB_PASSWORD', '')
+            'host': _ENV.get('XUI_DB_HOST', 'localhost'),
+            'port': int(_ENV.get('XUI_DB_PORT', 3306)),
+            'database': _ENV.get('XUI_DB_NAME', 'xui'),
+            'user': _ENV.get('XUI_DB_USER', 'root'),
+            'password': _ENV.get('XUI_DB_PASSWORD', '')
         }
     else:
         raise ValueError(f"Неподдерживаемый тип БД для XUI: {db_type}")
 
 def get_pasar_db_config():
     """Получает конфигурацию БД для Pasarguard"""
-    db_type = os.getenv('PASAR_DB_TYPE', 'sqlite').lower()
+    db_type = _ENV.get('PASAR_DB_TYPE', 'sqlite').lower()
     
     if db_type == 'sqlite':
         return {
             'db_type': 'sqlite',
-            'db_path': os.getenv('PASAR_DB_PATH', 'db.sqlite3')
+            'db_path': _ENV.get('PASAR_DB_PATH', 'db.sqlite3'),
+            # целевая БД: включаем WAL и остальные настройки для записи
+            'tune_for_writes': True
         }
     elif db_type in ['postgresql', 'postgres']:
         return {
             'db_type': 'postgresql',
-            'host': os.getenv('PASAR_DB_HOST', 'localhost'),
-            'port': int(os.getenv('PASAR_DB_PORT', 5432)),
-            'database': os.getenv('PASAR_DB_NAME', 'pasarguard'),
-            'user': os.getenv('PASAR_DB_USER', 'postgres'),
-            'password': os.getenv('PASAR_DB_PASSWORD', '')
+            'host': _ENV.get('PASAR_DB_HOST', 'localhost'),
+            'port': int(_ENV.get('PASAR_DB_PORT', 5432)),
+            'database': _ENV.get('PASAR_DB_NAME', 'pasarguard'),
+            'user': _ENV.get('PASAR_DB_USER', 'postgres'),
+            'password': _ENV.get('PASAR_DB_PASSWORD', '')
         }
     elif db_type in ['mysql', 'mariadb']:
         return {
             'db_type': db_type,
-            'host': os.getenv('PASAR_DB_HOST', 'localhost'),
-            'port': int(os.getenv('PASAR_DB_PORT', 3306)),
-            'database': os.getenv('PASAR_DB_NAME', 'pasarguard'),
-            'user': os.getenv('PASAR_DB_USER', 'root'),
-            'password': os.getenv('PASAR_DB_PASSWORD', '')
+            'host': _ENV.get('PASAR_DB_HOST', 'localhost'),
+            'port': int(_ENV.get('PASAR_DB_PORT', 3306)),
+            'database': _ENV.get('PASAR_DB_NAME', 'pasarguard'),
+            'user': _ENV.get('PASAR_DB_USER', 'root'),
+            'password': _ENV.get('PASAR_DB_PASSWORD', '')
         }
     else:
         raise ValueError(f"Неподдерживаемый тип БД для Pasarguard: {db_type}")
@@ -231,17 +388,20 @@ xui_cur.execute("SELECT id, settings FROM inbounds;")
 inbounds = xui_cur.fetchall()
 
 # получаем статистику трафика для клиентов
-xui_cur.execute("SELECT inbound_id, email, up, down, expiry_time, total FROM client_traffics;")
+# JOIN с inbounds отсекает на стороне БД записи без настроек —
+# им все равно не с чем сопоставиться на ШАГЕ 2
+xui_cur.execute("""
+    SELECT ct.inbound_id, ct.email, ct.up, ct.down, ct.expiry_time, ct.total
+    FROM client_traffics ct
+    JOIN inbounds i ON i.id = ct.inbound_id
+    WHERE i.settings IS NOT NULL AND i.settings != ''
+""")
+# значения храним кортежами (up, down, expiry_time, total):
+# словарь на каждую запись втрое тяжелее по памяти
 traffic_data = {}
 for row in xui_cur.fetchall():
     inbound_id, email, up, down, expiry_time, total = row
-    key = (inbound_id, email)
-    traffic_data[key] = {
-        "up": up,
-        "down": down,
-        "expiry_time": expiry_time,
-        "total": total
-    }
+    traffic_data[(inbound_id, email)] = (up, down, expiry_time, total)
 
 print(f"  Найдено inbounds: {len(inbounds)}")
 print(f"  Найдено записей трафика: {len(traffic_data)}")
@@ -249,14 +409,22 @@ print(f"  Найдено записей трафика: {len(traffic_data)}")
 # ШАГ 2: Извлекаем всех клиентов
 print("\n[ШАГ 2] Обработка клиентов из inbounds...")
 
-clients_data = []
+# Клиенты хранятся колонками (SoA) вместо списка словарей:
+# на больших выгрузках это в разы меньше аллокаций и памяти
+client_emails = []
+client_ids = []
+client_enables = []
+client_expiries = []
+client_totals = []
+client_ups = []
+client_downs = []
 
 for inbound_id, settings_json in inbounds:
     if not settings_json:
         continue
     
     try:
-        settings = json.loads(settings_json)
+        settings = json_loads(settings_json)
         clients = settings.get("clients", [])
         
         # обрабатываем каждого клиента
@@ -268,35 +436,32 @@ for inbound_id, settings_json in inbounds:
             total_gb = client.get("totalGB", 0)
             
             # получаем статистику трафика из client_traffics
-            traffic_key = (inbound_id, email)
-            if traffic_key in traffic_data:
-                up = traffic_data[traffic_key]["up"]
-                down = traffic_data[traffic_key]["down"]
+            traffic = traffic_data.get((inbound_id, email))
+            if traffic:
+                up, down, traffic_expiry, traffic_total = traffic
                 # используем expiry_time и total из client_traffics, если они есть
-                if traffic_data[traffic_key]["expiry_time"]:
-                    expiry_time = traffic_data[traffic_key]["expiry_time"]
-                if traffic_data[traffic_key]["total"]:
-                    total_gb = traffic_data[traffic_key]["total"] / (1024**3)  # конвертируем байты в GB
+                if traffic_expiry:
+                    expiry_time = traffic_expiry
+                if traffic_total:
+                    total_gb = traffic_total / (1024**3)  # конвертируем байты в GB
             else:
                 # если нет данных в client_traffics, используем значения из settings
                 up = 0
                 down = 0
             
-            clients_data.append({
-                "email": email,
-                "client_id": client_id,
-                "enable": enable,
-                "expiry_time": expiry_time,
-                "total_gb": total_gb,
-                "up": up,
-                "down": down
-            })
-            
+            client_emails.append(email)
+            client_ids.append(client_id)
+            client_enables.append(enable)
+            client_expiries.append(expiry_time)
+            client_totals.append(total_gb)
+            client_ups.append(up)
+            client_downs.append(down)
+
     except json.JSONDecodeError as e:
         print(f"  Ошибка парсинга JSON для inbound {inbound_id}: {e}")
         continue
 
-print(f"  Найдено клиентов: {len(clients_data)}")
+print(f"  Найдено клиентов: {len(client_emails)}")
 
 # ШАГ 3: Получаем admin_id из Pasarguard
 print("\n[ШАГ 3] Получение admin_id из Pasarguard...")
@@ -334,38 +499,63 @@ errors = 0
 # Используем %s везде, метод execute адаптирует для SQLite
 pasar_placeholder = '%s'
 
-for client in clients_data:
-    email = client["email"]
-    client_id = client["client_id"]
-    enabled = client["enable"]
-    expiry_time = client["expiry_time"]
-    total_gb = client["total_gb"]
-    up = client["up"]
-    down = client["down"]
+# Оборачиваем весь импорт в явную транзакцию, чтобы не делать
+# fsync на каждый отдельный INSERT/UPDATE
+# (PRAGMA для SQLite выставляются при подключении в DatabaseConnection)
+pasar.begin()
+
+# Заранее загружаем всех существующих пользователей одним запросом,
+# чтобы не делать SELECT на каждого клиента
+pasar_cur.execute("SELECT id, username, proxy_settings FROM users")
+existing_users = {row[1]: (row[0], row[2]) for row in pasar_cur.fetchall()}
+
+# Временная метка миграции: считаем один раз, strftime с %f
+# слишком дорог, чтобы звать его по 2-3 раза на пользователя
+# (скрипт и так помечает все строки одним событием миграции)
+migration_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+# Новые пользователи и обновления накапливаются в списки
+# и отправляются в БД пачками. queued_usernames отсекает повторы
+# одного email из разных inbounds: раньше их ловил построчный SELECT,
+# теперь дубль в to_insert уронил бы всю пачку по UNIQUE(username)
+to_insert = []
+to_update = []
+new_usernames = []
+queued_usernames = set()
+
+clients_iter = zip(client_emails, client_ids, client_enables,
+                   client_expiries, client_totals, client_ups, client_downs)
+for processed, (email, client_id, enabled, expiry_time, total_gb, up, down) in enumerate(clients_iter, 1):
+    # периодически сбрасываем накопленный вывод
+    if processed % 1000 == 0:
+        sys.stdout.flush()
+
     used_traffic = up + down
-    
+
     if not email:
         skipped += 1
         continue
-    
-    # проверяем, существует ли уже пользователь
-    pasar_cur.execute("SELECT id FROM users WHERE username = %s", (email,))
-    existing = pasar_cur.fetchone()
-    
-    if existing:
-        user_id = existing[0]
+
+    # email уже подготовлен к вставке в этом запуске (тот же клиент
+    # в нескольких inbounds) — повторную вставку пропускаем
+    if email in queued_usernames:
+        skipped += 1
+        print(f"  Пропущен дубликат: {email}")
+        continue
+
+    # проверяем, существует ли уже пользователь (по заранее загруженному словарю)
+    if email in existing_users:
+        user_id, current_proxy_settings = existing_users[email]
         # обновляем существующего пользователя
         try:
-            # получаем текущие proxy_settings
-            pasar_cur.execute("SELECT proxy_settings FROM users WHERE id = %s", (user_id,))
-            result = pasar_cur.fetchone()
-            if result and result[0]:
-                proxy_settings = json.loads(result[0])
+            # текущие proxy_settings уже загружены вместе со списком пользователей
+            if current_proxy_settings:
+                proxy_settings = json_loads(current_proxy_settings)
             else:
                 proxy_settings = {}
             
             # ВСЕГДА устанавливаем created_at на текущую дату миграции
-            created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            created_at = migration_ts
             
             # обновляем proxy_settings если нужно
             needs_update = False
@@ -413,52 +603,40 @@ for client in clients_data:
                     expiry_time = expiry_time / 1000
                 expire_date = datetime.fromtimestamp(expiry_time).strftime("%Y-%m-%d %H:%M:%S.000000")
             
-            traffic_limit = total_gb * (1024**3) if total_gb else None
-            
-            # Адаптируем запрос для разных БД
+            # total_gb бывает float (байты из client_traffics делятся на 1024^3);
+            # приводим к int, COPY в отличие от INSERT не кастует float в bigint
+            traffic_limit = int(total_gb * (1024**3)) if total_gb else None
+
             # ВСЕГДА обновляем created_at на текущую дату миграции
-            update_query = """
-                UPDATE users SET
-                    status = %s,
-                    used_traffic = %s,
-                    data_limit = %s,
-                    expire = %s,
-                    proxy_settings = %s,
-                    created_at = %s,
-                    edit_at = %s
-                WHERE id = %s
-            """
-            pasar_cur.execute(update_query, (
+            to_update.append((
                 status,
                 used_traffic,
                 traffic_limit,
                 expire_date,
-                json.dumps(proxy_settings),
+                json_dumps(proxy_settings),
                 created_at,
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+                migration_ts,
                 user_id
             ))
-            
-            updated += 1
-            print(f"  Обновлен: {email}")
-            
+            print(f"  Подготовлен к обновлению: {email}")
+
         except Exception as e:
             print(f"  ОШИБКА при обновлении {email}: {e}")
             errors += 1
         continue
     
-    # создаем нового пользователя
+    # готовим кортеж для нового пользователя
     try:
         # генерируем валидные UUID для VMess и VLESS
         if is_valid_uuid(client_id):
             valid_uuid = client_id
         else:
             valid_uuid = str(uuid.uuid4())
-        
+
         # генерируем валидные пароли
         ss_password = generate_password(22)
         trojan_password = generate_password(22)
-        
+
         # создаем proxy_settings (vmess первым)
         proxy_settings = {
             "vmess": {"id": valid_uuid},
@@ -466,81 +644,134 @@ for client in clients_data:
             "trojan": {"password": trojan_password},
             "shadowsocks": {"password": ss_password, "method": "chacha20-ietf-poly1305"}
         }
-        
+
         # определяем статус
         status = "active" if enabled else "disabled"
-        
+
         # конвертируем expiry_time в DATETIME
         expire_date = None
         if expiry_time and expiry_time > 0:
             if expiry_time > 10000000000:
                 expiry_time = expiry_time / 1000
             expire_date = datetime.fromtimestamp(expiry_time).strftime("%Y-%m-%d %H:%M:%S.000000")
-        
-        traffic_limit = total_gb * (1024**3) if total_gb else None
-        
-        # Адаптируем запрос для разных БД
-        insert_query = """
-            INSERT INTO users (
-                username, status, used_traffic, data_limit, created_at, 
-                admin_id, data_limit_reset_strategy, expire, proxy_settings
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        
-        # Для PostgreSQL нужно получить lastrowid по-другому
-        if pasar_config['db_type'] in ['postgresql', 'postgres']:
-            insert_query += " RETURNING id"
-        
-        pasar_cur.execute(insert_query, (
+
+        # total_gb бывает float (байты из client_traffics делятся на 1024^3);
+        # приводим к int, COPY в отличие от INSERT не кастует float в bigint
+        traffic_limit = int(total_gb * (1024**3)) if total_gb else None
+
+        to_insert.append((
             email,
             status,
             used_traffic,
             traffic_limit,
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+            migration_ts,
             admin_id,
             "no_reset",
             expire_date,
-            json.dumps(proxy_settings)
+            json_dumps(proxy_settings)
         ))
-        
-        # Получаем ID вставленной строки
-        if pasar_config['db_type'] in ['postgresql', 'postgres']:
-            result = pasar_cur.fetchone()
-            user_id = result[0] if result else None
-        else:
-            user_id = pasar_cur.lastrowid
-        
-        # привязываем к группе если группа существует
-        if group_id and user_id:
+        new_usernames.append(email)
+        queued_usernames.add(email)
+        print(f"  Подготовлен: {email} (traffic: {used_traffic})")
+
+    except Exception as e:
+        print(f"  ОШИБКА при подготовке {email}: {e}")
+        errors += 1
+
+# массовая вставка новых пользователей пачками по 5000 строк,
+# с промежуточным коммитом каждые 10000 строк, чтобы ограничить рост WAL
+BULK_CHUNK = 5000
+COMMIT_EVERY = 10000
+
+if pasar_config['db_type'] in ['postgresql', 'postgres'] and to_insert:
+    # PostgreSQL: шардируем вставку по потокам, каждый воркер берет
+    # свое соединение из пула и коммитит свой шард независимо
+    shards = [to_insert[i:i + BULK_CHUNK] for i in range(0, len(to_insert), BULK_CHUNK)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {executor.submit(insert_users_shard_pg, pasar, shard): len(shard)
+                   for shard in shards}
+        for future in as_completed(futures):
             try:
-                # Адаптируем INSERT OR IGNORE для разных БД
-                if pasar_config['db_type'] == 'sqlite':
-                    insert_group_query = """
-                        INSERT OR IGNORE INTO users_groups_association (user_id, groups_id)
-                        VALUES (%s, %s)
-                    """
-                elif pasar_config['db_type'] in ['postgresql', 'postgres']:
-                    insert_group_query = """
-                        INSERT INTO users_groups_association (user_id, groups_id)
-                        VALUES (%s, %s)
-                        ON CONFLICT DO NOTHING
-                    """
-                else:  # MySQL/MariaDB
-                    insert_group_query = """
-                        INSERT IGNORE INTO users_groups_association (user_id, groups_id)
-                        VALUES (%s, %s)
-                    """
-                
-                pasar_cur.execute(insert_group_query, (user_id, group_id))
+                future.result()
+                imported += futures[future]
+                print(f"  Вставлено пользователей: {imported}/{len(to_insert)}")
+                sys.stdout.flush()
             except Exception as e:
-                print(f"  Предупреждение: не удалось привязать к группе: {e}")
-        
-        imported += 1
-        print(f"  Импортирован: {email} (traffic: {used_traffic})")
-        
+                print(f"  ОШИБКА при массовой вставке ({futures[future]} строк): {e}")
+                errors += futures[future]
+else:
+    rows_since_commit = 0
+    for i in range(0, len(to_insert), BULK_CHUNK):
+        chunk = to_insert[i:i + BULK_CHUNK]
+        try:
+            bulk_insert_users(pasar_cur, chunk, pasar_config['db_type'])
+            imported += len(chunk)
+            rows_since_commit += len(chunk)
+            print(f"  Вставлено пользователей: {imported}/{len(to_insert)}")
+            sys.stdout.flush()
+            if rows_since_commit >= COMMIT_EVERY:
+                pasar.commit()
+                pasar.begin()
+                rows_since_commit = 0
+        except Exception as e:
+            print(f"  ОШИБКА при массовой вставке ({len(chunk)} строк): {e}")
+            errors += len(chunk)
+
+# массовое обновление существующих пользователей теми же пачками
+for i in range(0, len(to_update), BULK_CHUNK):
+    chunk = to_update[i:i + BULK_CHUNK]
+    try:
+        bulk_update_users(pasar_cur, chunk, pasar_config['db_type'])
+        updated += len(chunk)
+        print(f"  Обновлено пользователей: {updated}/{len(to_update)}")
+        sys.stdout.flush()
     except Exception as e:
-        print(f"  ОШИБКА при импорте {email}: {e}")
-        errors += 1
+        print(f"  ОШИБКА при массовом обновлении ({len(chunk)} строк): {e}")
+        errors += len(chunk)
+
+# привязываем новых пользователей к группе
+if group_id and new_usernames:
+    # Адаптируем INSERT OR IGNORE для разных БД
+    if pasar_config['db_type'] == 'sqlite':
+        insert_group_query = """
+            INSERT OR IGNORE INTO users_groups_association (user_id, groups_id)
+            VALUES (%s, %s)
+        """
+    elif pasar_config['db_type'] in ['postgresql', 'postgres']:
+        insert_group_query = """
+            INSERT INTO users_groups_association (user_id, groups_id)
+            VALUES (%s, %s)
+            ON CONFLICT DO NOTHING
+        """
+    else:  # MySQL/MariaDB
+        insert_group_query = """
+            INSERT IGNORE INTO users_groups_association (user_id, groups_id)
+            VALUES (%s, %s)
+        """
+
+    # получаем ID вставленных пользователей чанками по 1000 имен
+    assoc_pairs = []
+    for i in range(0, len(new_usernames), 1000):
+        names = new_usernames[i:i + 1000]
+        placeholders = ', '.join(['%s'] * len(names))
+        try:
+            pasar_cur.execute(
+                f"SELECT id FROM users WHERE username IN ({placeholders})",
+                tuple(names)
+            )
+            assoc_pairs.extend((user_id, group_id) for (user_id,) in pasar_cur.fetchall())
+        except Exception as e:
+            print(f"  Предупреждение: не удалось получить ID для привязки к группе: {e}")
+
+    # вставляем все связи одной пачкой вместо INSERT на каждого пользователя
+    try:
+        if pasar_config['db_type'] in ['postgresql', 'postgres']:
+            from psycopg2.extras import execute_batch
+            execute_batch(pasar_cur.cursor, insert_group_query, assoc_pairs, page_size=1000)
+        else:
+            pasar_cur.executemany(insert_group_query, assoc_pairs)
+    except Exception as e:
+        print(f"  Предупреждение: не удалось привязать к группе: {e}")
 
 # сохраняем изменения
 pasar.commit()